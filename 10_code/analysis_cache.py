@@ -0,0 +1,335 @@
+"""File for caching the results of repeated analysis runs on disk."""
+
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+
+############### Settings ###############
+
+# paths are anchored at the repository root so the cache works from anywhere
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# folder where the cached results are written
+CACHE_DIR = os.path.join(ROOT, "20_intermediate_files", "analysis_cache")
+
+# processed data file, the cache is cleared whenever this file changes
+PROCESSED_DATA = os.path.join(ROOT, "05_clean_data", "processed_data_clean_final.csv")
+
+# maximum size of the cache folder before the oldest results are evicted
+MAX_CACHE_BYTES = 512 * 1024 * 1024
+
+# name of the file that records which version of the processed data was cached
+VERSION_FILE = "_data_version"
+
+
+############### Functions ###############
+def data_version(path=PROCESSED_DATA):
+    """
+    Get a version string for the processed data file.
+
+    Parameters
+    ----------
+    path : str
+        The path of the processed data file.
+
+    Returns
+    -------
+    str
+        A string built from the size and modification time of the file, or
+        "missing" if the file does not exist.
+    """
+    if not os.path.exists(path):
+        return "missing"
+    stat = os.stat(path)
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def fingerprint(obj, hasher=None):
+    """
+    Hash an argument of an analysis function.
+
+    Parameters
+    ----------
+    obj : object
+        The argument to hash. Dataframes, series and arrays are hashed by
+        their content; containers are hashed element by element and anything
+        else by its repr.
+    hasher : hashlib object
+        The hash object to update. A new one is made if None.
+
+    Returns
+    -------
+    str
+        The hex digest of the hash.
+    """
+    if hasher is None:
+        hasher = hashlib.sha256()
+
+    if isinstance(obj, pd.DataFrame):
+        hasher.update(b"frame")
+        hasher.update(repr(list(obj.columns)).encode())
+        hasher.update(repr([str(t) for t in obj.dtypes]).encode())
+        hasher.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+    elif isinstance(obj, pd.Series):
+        hasher.update(b"series")
+        hasher.update(repr((obj.name, str(obj.dtype))).encode())
+        hasher.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+    elif isinstance(obj, np.ndarray):
+        hasher.update(b"array")
+        hasher.update(repr((obj.dtype.str, obj.shape)).encode())
+        hasher.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, dict):
+        hasher.update(b"dict")
+        for key in sorted(obj, key=repr):
+            hasher.update(repr(key).encode())
+            fingerprint(obj[key], hasher)
+    elif isinstance(obj, (list, tuple)):
+        hasher.update(type(obj).__name__.encode())
+        for item in obj:
+            fingerprint(item, hasher)
+    else:
+        hasher.update(repr(obj).encode())
+
+    return hasher.hexdigest()
+
+
+def _function_id(func):
+    """
+    Build an identifier for a function that changes when its code changes.
+
+    Parameters
+    ----------
+    func : callable
+        The function to identify.
+
+    Returns
+    -------
+    str
+        The module, name and a hash of the source of the function.
+    """
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = ""
+    source_hash = hashlib.sha256(source.encode()).hexdigest()[:16]
+    return f"{func.__module__}.{func.__qualname__}:{source_hash}"
+
+
+def _slice_panel(df, city, columns):
+    """
+    Reduce a dataframe argument to the part the analysis actually reads.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The dataframe passed to the analysis function.
+    city : str or None
+        The city to keep. All rows are kept if None.
+    columns : list or None
+        The columns to keep. All columns are kept if None.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The slice of the dataframe to fingerprint.
+    """
+    if city is not None and "city" in df.columns:
+        df = df[df["city"] == city]
+    if columns is not None:
+        df = df[[col for col in columns if col in df.columns]]
+    return df
+
+
+def _check_version(cache_dir):
+    """
+    Clear the cache folder if the processed data changed since it was filled.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The cache folder.
+
+    Returns
+    -------
+    None
+    """
+    version = data_version()
+    version_path = os.path.join(cache_dir, VERSION_FILE)
+
+    if os.path.exists(version_path):
+        with open(version_path) as f:
+            if f.read() == version:
+                return
+
+    clear_cache(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # another process may be writing the same file, so swap it in whole
+    tmp_path = f"{version_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(version)
+    os.replace(tmp_path, version_path)
+
+
+def _evict(cache_dir, max_bytes):
+    """
+    Remove the least recently used results until the cache fits its budget.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The cache folder.
+    max_bytes : int
+        The maximum total size of the cached results.
+
+    Returns
+    -------
+    None
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(".pkl"):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+
+    # the modification time is refreshed on every hit, so oldest goes first
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def clear_cache(cache_dir=CACHE_DIR):
+    """
+    Delete every cached result.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The cache folder.
+
+    Returns
+    -------
+    None
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        if name.endswith(".pkl") or name == VERSION_FILE:
+            # another process clearing the cache may have removed it already
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                pass
+
+
+def cached(
+    city_arg=None,
+    columns=None,
+    depends_on=(),
+    cache_dir=CACHE_DIR,
+    max_bytes=MAX_CACHE_BYTES,
+):
+    """
+    Decorate an analysis function so its results are memoized on disk.
+
+    The key combines the function and its source code, the scalar parameters
+    and a content hash of every dataframe or array argument. If city_arg is
+    given, dataframe arguments are reduced to that city (and to columns, if
+    given) before hashing so edits to other cities do not invalidate results.
+    The source of every function in depends_on is part of the key too, so
+    editing a helper the function calls also invalidates its results.
+
+    Parameters
+    ----------
+    city_arg : str
+        The name of the parameter holding the city name. Default is None.
+    columns : list
+        The dataframe columns the function reads. Default is None, all columns.
+    depends_on : list
+        The helper functions whose results feed this one. Default is none.
+    cache_dir : str
+        The cache folder. Default is CACHE_DIR.
+    max_bytes : int
+        The maximum size of the cache folder. Default is MAX_CACHE_BYTES.
+
+    Returns
+    -------
+    decorator : callable
+        The decorator to apply to the analysis function.
+
+    Examples
+    --------
+    >>> @cached(
+    ...     city_arg="city_name",
+    ...     columns=["city", "year", "month", "date"],
+    ...     depends_on=[target_days, actual_days],
+    ... )
+    ... def missing_days(city_name, df, option):
+    ...     ...
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+        func_id = "|".join(_function_id(f) for f in [func, *depends_on])
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            city = bound.arguments.get(city_arg) if city_arg else None
+
+            # hash the function and its arguments into one key
+            hasher = hashlib.sha256(func_id.encode())
+            for name, value in bound.arguments.items():
+                hasher.update(name.encode())
+                if isinstance(value, pd.DataFrame):
+                    value = _slice_panel(value, city, columns)
+                fingerprint(value, hasher)
+            key = hasher.hexdigest()
+
+            _check_version(cache_dir)
+            path = os.path.join(cache_dir, f"{func.__name__}-{key[:32]}.pkl")
+
+            # return the stored result on a hit and mark it as recently used
+            if os.path.exists(path):
+                try:
+                    with open(path, "rb") as f:
+                        result = pickle.load(f)
+                    os.utime(path)
+                    return result
+                except (OSError, EOFError, pickle.UnpicklingError):
+                    pass
+
+            result = func(*args, **kwargs)
+
+            # write to a temporary file first so readers never see half a file
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+
+            _evict(cache_dir, max_bytes)
+            return result
+
+        wrapper.uncached = func
+        return wrapper
+
+    return decorator
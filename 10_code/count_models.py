@@ -0,0 +1,455 @@
+"""File for fitting Poisson and negative binomial models across many cities at once."""
+
+import numpy as np
+import pandas as pd
+from scipy import special, stats
+
+
+############### Settings ###############
+
+# the end of period flags made in data_preprocess.py
+TREATMENTS = ["end_of_month", "end_of_quarter", "end_of_year"]
+
+# floor for the fitted means so the log link never sees zero
+MU_FLOOR = 1e-8
+
+# bounds on log(alpha) for the negative binomial dispersion
+LOG_ALPHA_BOUNDS = (np.log(1e-8), np.log(1e3))
+
+
+############### Functions ###############
+def build_panels(
+    df, cities=None, treatments=TREATMENTS, metric="citation_issued", day_of_week=True
+):
+    """
+    Build the design of every (city, treatment) model.
+
+    Each design has an intercept, the treatment flag, year dummies (the
+    same time effects as the PanelOLS notebooks) and optionally day of week
+    dummies.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The processed data.
+    cities : list
+        The cities to fit. Default is None, every city in df.
+    treatments : list
+        The flag columns to use as treatment. Default is TREATMENTS.
+    metric : str
+        The count outcome. Default is "citation_issued."
+    day_of_week : bool
+        Whether to add day of week dummies. Default is True.
+
+    Returns
+    -------
+    panels : list of dict
+        One dict per model with city, treatment, y, X, names and year codes.
+    """
+    if cities is None:
+        cities = sorted(df["city"].unique())
+
+    panels = []
+    for city in cities:
+        city_df = df[df["city"] == city]
+        y = city_df[metric].to_numpy(dtype=float)
+
+        # dummies shared by every treatment of this city
+        years = pd.get_dummies(city_df["year"], prefix="year", drop_first=True)
+        controls = [years]
+        if day_of_week:
+            controls.append(
+                pd.get_dummies(city_df["day_of_week"], prefix="dow", drop_first=True)
+            )
+        controls = pd.concat(controls, axis=1).astype(float)
+        year_codes = pd.factorize(city_df["year"], sort=True)[0]
+
+        for treatment in treatments:
+            X = np.column_stack(
+                [
+                    np.ones(len(y)),
+                    city_df[treatment].to_numpy(dtype=float),
+                    controls.to_numpy(),
+                ]
+            )
+            panels.append(
+                {
+                    "city": city,
+                    "treatment": treatment,
+                    "y": y,
+                    "X": X,
+                    "names": ["const", treatment] + list(controls.columns),
+                    "year_codes": year_codes,
+                }
+            )
+    return panels
+
+
+def stack_panels(panels):
+    """
+    Pad the panels to a common size so they can be fit as one batch.
+
+    Parameters
+    ----------
+    panels : list of dict
+        The panels from build_panels.
+
+    Returns
+    -------
+    X : numpy.ndarray
+        The (B, n, p) designs, zero padded.
+    y : numpy.ndarray
+        The (B, n) outcomes, zero padded.
+    row_mask : numpy.ndarray
+        The (B, n) mask of real observations.
+    col_mask : numpy.ndarray
+        The (B, p) mask of real columns.
+    """
+    n_max = max(len(panel["y"]) for panel in panels)
+    p_max = max(panel["X"].shape[1] for panel in panels)
+
+    X = np.zeros((len(panels), n_max, p_max))
+    y = np.zeros((len(panels), n_max))
+    row_mask = np.zeros((len(panels), n_max), dtype=bool)
+    col_mask = np.zeros((len(panels), p_max), dtype=bool)
+
+    for i, panel in enumerate(panels):
+        n, p = panel["X"].shape
+        X[i, :n, :p] = panel["X"]
+        y[i, :n] = panel["y"]
+        row_mask[i, :n] = True
+        col_mask[i, :p] = True
+
+    return X, y, row_mask, col_mask
+
+
+def warm_start(panels, X, row_mask):
+    """
+    Start every model at the fit with year effects only.
+
+    The Poisson MLE with only year effects sets each fitted mean to the
+    year mean, so the linear predictor log(year mean) is projected onto the
+    design. Every treatment of a city starts from the same point.
+
+    Parameters
+    ----------
+    panels : list of dict
+        The panels from build_panels.
+    X : numpy.ndarray
+        The stacked designs.
+    row_mask : numpy.ndarray
+        The mask of real observations.
+
+    Returns
+    -------
+    numpy.ndarray
+        The (B, p) starting coefficients.
+    """
+    eta = np.zeros(row_mask.shape)
+    for i, panel in enumerate(panels):
+        codes = panel["year_codes"]
+        year_mean = np.bincount(codes, panel["y"]) / np.bincount(codes)
+        eta[i, : len(codes)] = np.log(year_mean[codes] + 0.1)
+
+    Xm = X * row_mask[:, :, None]
+    return _batched_solve(Xm.transpose(0, 2, 1) @ Xm, np.einsum("bnp,bn->bp", Xm, eta))
+
+
+def _batched_solve(A, b):
+    """
+    Solve a batch of symmetric systems, falling back to pinv if singular.
+
+    Parameters
+    ----------
+    A : numpy.ndarray
+        The (B, p, p) matrices.
+    b : numpy.ndarray
+        The (B, p) right hand sides.
+
+    Returns
+    -------
+    numpy.ndarray
+        The (B, p) solutions.
+    """
+    try:
+        return np.linalg.solve(A, b[:, :, None])[:, :, 0]
+    except np.linalg.LinAlgError:
+        return np.einsum("bpq,bq->bp", np.linalg.pinv(A), b)
+
+
+def _log_alpha_score(log_alpha, y, mu, weights_mask):
+    """
+    Get the derivative of the NB2 log likelihood with respect to log(alpha).
+
+    Parameters
+    ----------
+    log_alpha : numpy.ndarray
+        The (B,) log dispersions.
+    y : numpy.ndarray
+        The (B, n) outcomes.
+    mu : numpy.ndarray
+        The (B, n) fitted means.
+    weights_mask : numpy.ndarray
+        The (B, n) mask of real observations as floats.
+
+    Returns
+    -------
+    numpy.ndarray
+        The (B,) scores.
+    """
+    alpha = np.exp(log_alpha)[:, None]
+    r = 1 / alpha
+    unit = -r * (
+        special.digamma(y + r) - special.digamma(r) - np.log1p(alpha * mu)
+    ) + (y - mu) / (1 + alpha * mu)
+    return (unit * weights_mask).sum(axis=1)
+
+
+def _update_log_alpha(log_alpha, y, mu, weights_mask, n_steps=3, step=1e-4):
+    """
+    Move log(alpha) towards the NB2 maximum likelihood estimate for fixed mu.
+
+    Every model takes the same few Newton steps at once, with the second
+    derivative taken by central differences of the score.
+
+    Parameters
+    ----------
+    log_alpha : numpy.ndarray
+        The (B,) log dispersions.
+    y : numpy.ndarray
+        The (B, n) outcomes.
+    mu : numpy.ndarray
+        The (B, n) fitted means.
+    weights_mask : numpy.ndarray
+        The (B, n) mask of real observations as floats.
+    n_steps : int
+        The number of Newton steps. Default is 3.
+    step : float
+        The finite difference step. Default is 1e-4.
+
+    Returns
+    -------
+    numpy.ndarray
+        The (B,) updated log dispersions.
+    """
+    for _ in range(n_steps):
+        score = _log_alpha_score(log_alpha, y, mu, weights_mask)
+        hess = (
+            _log_alpha_score(log_alpha + step, y, mu, weights_mask)
+            - _log_alpha_score(log_alpha - step, y, mu, weights_mask)
+        ) / (2 * step)
+        # fall back to a fixed move uphill where the likelihood is not concave
+        concave = hess < 0
+        newton = np.where(
+            concave, -score / np.where(concave, hess, 1.0), np.sign(score)
+        )
+        log_alpha = np.clip(log_alpha + np.clip(newton, -1.0, 1.0), *LOG_ALPHA_BOUNDS)
+    return log_alpha
+
+
+def fit_batched_glm(
+    X,
+    y,
+    row_mask,
+    col_mask,
+    family="poisson",
+    start=None,
+    alpha=None,
+    tol=1e-8,
+    max_iter=100,
+):
+    """
+    Fit a batch of log-link count models by IRLS.
+
+    Every iteration forms all the weighted normal equations with one batched
+    matmul and solves them with one batched solve. For the negative binomial
+    (NB2) every IRLS step is followed by Newton steps on the profile
+    likelihood of alpha, so the fit converges to the joint maximum
+    likelihood estimate. Iteration stops once neither the coefficients nor
+    log(alpha) change by more than tol.
+
+    The model based covariance treats alpha as known, which is the usual
+    NB2 result since the information matrix is block diagonal between the
+    coefficients and alpha.
+
+    Parameters
+    ----------
+    X : numpy.ndarray
+        The (B, n, p) designs from stack_panels.
+    y : numpy.ndarray
+        The (B, n) outcomes.
+    row_mask : numpy.ndarray
+        The (B, n) mask of real observations.
+    col_mask : numpy.ndarray
+        The (B, p) mask of real columns.
+    family : str
+        Can be "poisson" or "negbin". Default is "poisson".
+    start : numpy.ndarray
+        The (B, p) starting coefficients. Default is None, all zero.
+    alpha : numpy.ndarray
+        The (B,) starting dispersion for "negbin". Default is None, 1.
+    tol : float
+        The largest change in a coefficient or in log(alpha) to stop at.
+        Default is 1e-8.
+    max_iter : int
+        The maximum number of iterations. Default is 100.
+
+    Returns
+    -------
+    dict
+        The coefficients (params), model based (cov) and robust (cov_robust)
+        covariances, dispersion (alpha), convergence flags (converged) and
+        iteration count (n_iter).
+    """
+    if family not in ["poisson", "negbin"]:
+        raise ValueError("family must be poisson or negbin")
+
+    B, n, p = X.shape
+    weights_mask = row_mask.astype(float)
+    # unit diagonal on padded columns keeps every system solvable
+    pad = np.einsum("bp,pq->bpq", (~col_mask).astype(float), np.eye(p))
+
+    params = np.zeros((B, p)) if start is None else np.array(start, dtype=float)
+    if family == "poisson":
+        alpha = np.zeros(B)
+    elif alpha is None:
+        alpha = np.ones(B)
+    else:
+        alpha = np.array(alpha, dtype=float)
+
+    log_alpha = np.log(np.maximum(alpha, np.exp(LOG_ALPHA_BOUNDS[0])))
+    converged = np.zeros(B, dtype=bool)
+
+    for n_iter in range(1, max_iter + 1):
+        eta = np.einsum("bnp,bp->bn", X, params)
+        mu = np.maximum(np.exp(eta), MU_FLOOR)
+
+        # IRLS weights and working response for the log link
+        alpha = np.exp(log_alpha) if family == "negbin" else np.zeros(B)
+        w = weights_mask * mu / (1 + alpha[:, None] * mu)
+        z = eta + (y - mu) / mu
+
+        XtW = X * w[:, :, None]
+        XtWX = XtW.transpose(0, 2, 1) @ X + pad
+        XtWz = np.einsum("bnp,bn->bp", XtW, z)
+        new_params = _batched_solve(XtWX, XtWz)
+        change = np.abs(new_params - params).max(axis=1)
+        # models that already converged keep their coefficients
+        params = np.where(converged[:, None], params, new_params)
+
+        eta = np.einsum("bnp,bp->bn", X, params)
+        mu = np.maximum(np.exp(eta), MU_FLOOR)
+
+        if family == "negbin":
+            new_log_alpha = _update_log_alpha(log_alpha, y, mu, weights_mask)
+            change = np.maximum(change, np.abs(new_log_alpha - log_alpha))
+            log_alpha = np.where(converged, log_alpha, new_log_alpha)
+
+        converged |= change < tol
+
+        if converged.all():
+            break
+
+    # information matrix and sandwich at the final estimates
+    alpha = np.exp(log_alpha) if family == "negbin" else np.zeros(B)
+    var = mu + alpha[:, None] * mu**2
+    w = weights_mask * mu**2 / var
+    bread = np.linalg.pinv((X * w[:, :, None]).transpose(0, 2, 1) @ X + pad)
+    scores = X * ((y - mu) * weights_mask * mu / var)[:, :, None]
+    meat = scores.transpose(0, 2, 1) @ scores
+    nobs = row_mask.sum(axis=1)
+    n_params = col_mask.sum(axis=1)
+    correction = (nobs / (nobs - n_params))[:, None, None]
+    cov_robust = correction * bread @ meat @ bread
+
+    return {
+        "params": params,
+        "cov": bread,
+        "cov_robust": cov_robust,
+        "alpha": alpha,
+        "converged": converged,
+        "n_iter": n_iter,
+    }
+
+
+def count_model_table(
+    df,
+    family="poisson",
+    cities=None,
+    treatments=TREATMENTS,
+    metric="citation_issued",
+    day_of_week=True,
+    cov_type="robust",
+    conf_interval=0.95,
+):
+    """
+    Fit one count model per (city, treatment) and tabulate the treatment effects.
+
+    When family is "negbin" (NB2 by maximum likelihood) the Poisson batch is
+    fit first and used as the warm start, since the two share the same mean
+    specification.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The processed data.
+    family : str
+        Can be "poisson" or "negbin". Default is "poisson".
+    cities : list
+        The cities to fit. Default is None, every city in df.
+    treatments : list
+        The flag columns to use as treatment. Default is TREATMENTS.
+    metric : str
+        The count outcome. Default is "citation_issued."
+    day_of_week : bool
+        Whether to add day of week dummies. Default is True.
+    cov_type : str
+        Can be "robust" or "unadjusted". Default is "robust".
+    conf_interval : float
+        The confidence level. Default is 0.95.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per (city, treatment) with the log-scale coef, std_err,
+        z_stat, p_value, ci_lower, ci_upper, the incidence rate ratio (irr),
+        alpha, nobs and converged.
+    """
+    if cov_type not in ["robust", "unadjusted"]:
+        raise ValueError("cov_type must be robust or unadjusted")
+
+    panels = build_panels(df, cities, treatments, metric, day_of_week)
+    X, y, row_mask, col_mask = stack_panels(panels)
+
+    start = warm_start(panels, X, row_mask)
+    fit = fit_batched_glm(X, y, row_mask, col_mask, "poisson", start=start)
+    if family == "negbin":
+        fit = fit_batched_glm(X, y, row_mask, col_mask, "negbin", start=fit["params"])
+    elif family != "poisson":
+        raise ValueError("family must be poisson or negbin")
+
+    cov = fit["cov_robust"] if cov_type == "robust" else fit["cov"]
+
+    # the treatment flag is always the second column
+    coef = fit["params"][:, 1]
+    std_err = np.sqrt(cov[:, 1, 1])
+    z_stat = coef / std_err
+    crit = stats.norm.ppf(1 - (1 - conf_interval) / 2)
+
+    return pd.DataFrame(
+        {
+            "city": [panel["city"] for panel in panels],
+            "term": [panel["treatment"] for panel in panels],
+            "model": family,
+            "coef": coef,
+            "std_err": std_err,
+            "z_stat": z_stat,
+            "p_value": 2 * stats.norm.sf(np.abs(z_stat)),
+            "ci_lower": coef - crit * std_err,
+            "ci_upper": coef + crit * std_err,
+            "irr": np.exp(coef),
+            "alpha": fit["alpha"],
+            "nobs": row_mask.sum(axis=1),
+            "converged": fit["converged"],
+        }
+    )
@@ -5,6 +5,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 import datetime as dt
 
+from analysis_cache import cached
+
 
 def plot_time_period(city, period, data, metric="citation_issued"):
     """
@@ -280,6 +282,11 @@ def actual_days(city_name, df):
     return actual_daysz
 
 
+@cached(
+    city_arg="city_name",
+    columns=["city", "year", "month", "date", "citation_issued"],
+    depends_on=[target_days, actual_days],
+)
 def missing_days(city_name, df, option):
     """
     Get the missing days.
@@ -6,6 +6,7 @@ import numpy as np
 import calendar
 import datetime
 import glob
+import os
 
 
 ############### Functions ###############
@@ -173,24 +174,27 @@ def quarter_calc(in_date, state):
     return days_out, qtr_out
 
 
-def data_process():
+def data_process(
+    folder="../00_source_data/", out_path="../05_clean_data/processed_data_revised.csv"
+):
 
     """Function to process data
 
     Parameters
     ----------
-    None
+    folder : str
+        The folder holding the source csv files
+
+    out_path : str
+        The path to save the processed csv file
 
     Returns
     -------
     None
     """
 
-    # Set the working directory
-    folder = "../00_source_data/"
-
     # Create a list of the files in the folder
-    files = glob.glob(folder + "*.csv")
+    files = sorted(glob.glob(os.path.join(folder, "*.csv")))
 
     # Make a base dataframe
     final_df = pd.DataFrame()
@@ -249,8 +253,8 @@ def data_process():
         ), "We lost some data"
 
         # add a city and state from the file name
-        group_df["city"] = file.split("_")[3]
-        group_df["state"] = file.split("_")[2].split("/")[1]
+        group_df["city"] = os.path.basename(file).split("_")[1]
+        group_df["state"] = os.path.basename(file).split("_")[0]
 
         # concat the base_df to the final_df
         final_df = pd.concat([final_df, group_df])
@@ -321,7 +325,7 @@ def data_process():
         ]
 
     # save the final_df to a csv file
-    final_df.to_csv("../05_clean_data/processed_data_revised.csv")
+    final_df.to_csv(out_path)
 
     pass
 
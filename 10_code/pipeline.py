@@ -0,0 +1,629 @@
+"""File for rebuilding every project output with one command.
+
+Each stage declares the files it reads and writes. Stages run in parallel
+as soon as the stages that write their inputs are done, and a stage is
+skipped when its inputs, settings and outputs are unchanged since its last
+run.
+
+Usage (from the 10_code folder)::
+
+    python pipeline.py              # rebuild whatever is stale
+    python pipeline.py --force      # rebuild everything
+    python pipeline.py --dry-run    # list the stages that would run
+"""
+
+import argparse
+import concurrent.futures
+import glob
+import hashlib
+import inspect
+import json
+import os
+
+import pandas as pd
+
+
+############### Settings ###############
+
+# every path is anchored at the repository root so the runner works from anywhere
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CODE_DIR = os.path.join(ROOT, "10_code")
+SOURCE_DIR = os.path.join(ROOT, "00_source_data")
+REVISED_DATA = os.path.join(ROOT, "05_clean_data", "processed_data_revised.csv")
+PROCESSED_DATA = os.path.join(ROOT, "05_clean_data", "processed_data_clean_final.csv")
+RESULTS_DIR = os.path.join(ROOT, "30_results")
+STATE_FILE = os.path.join(ROOT, "20_intermediate_files", "pipeline_state.json")
+
+PERIODS = ["month", "quarter", "year"]
+
+# the analysis modules each stage function imports, so editing them reruns it
+STAGE_MODULES = {
+    "run_process": ["data_preprocess"],
+    "run_missing": ["data_logic", "analysis_cache"],
+    "run_lowess": [],
+    "run_fixed_effects": ["wild_bootstrap", "pooled_event_study"],
+    "run_pooled": ["pooled_event_study"],
+    "run_count_models": ["count_models"],
+}
+
+
+############### Stage functions ###############
+def run_process(folder, out_path):
+    """
+    Build the processed panel from the source csv files.
+
+    Parameters
+    ----------
+    folder : str
+        The folder holding the source csv files.
+    out_path : str
+        The path to save the processed csv file.
+
+    Returns
+    -------
+    None
+    """
+    from data_preprocess import data_process
+
+    data_process(folder=folder, out_path=out_path)
+
+
+def run_missing(city, data_path, out_path):
+    """
+    Save the missing days of one city by year and month.
+
+    Parameters
+    ----------
+    city : str
+        The city name.
+    data_path : str
+        The processed data file.
+    out_path : str
+        The csv file to write.
+
+    Returns
+    -------
+    None
+    """
+    from data_logic import missing_days
+
+    df = pd.read_csv(data_path)
+    year_miss = missing_days.uncached(city, df, "year")
+    month_miss = missing_days.uncached(city, df, "month")
+
+    rows = [
+        {"year": year, "month": 0, "missing_days": days}
+        for year, days in year_miss.items()
+    ]
+    rows += [
+        {"year": year, "month": month, "missing_days": days}
+        for year, months in month_miss.items()
+        for month, days in months.items()
+    ]
+    pd.DataFrame(rows, columns=["year", "month", "missing_days"]).to_csv(
+        out_path, index=False
+    )
+
+
+def run_lowess(city, period, data_path, csv_path, png_path, frac=0.2):
+    """
+    Fit and plot the LOWESS curve of citations against days to the deadline.
+
+    Parameters
+    ----------
+    city : str
+        The city name.
+    period : str
+        The reporting period. Can be one of month, quarter, or year.
+    data_path : str
+        The processed data file.
+    csv_path : str
+        The csv file to write the smoothed curve to.
+    png_path : str
+        The image file to write the plot to.
+    frac : float
+        The LOWESS span. Default is 0.2, as in lowess_reg.ipynb.
+
+    Returns
+    -------
+    None
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import statsmodels.api as sm
+
+    df = pd.read_csv(data_path)
+    city_df = df[df["city"] == city]
+    x = city_df[f"days_end_{period}"].to_numpy(dtype=float)
+    y = city_df["citation_issued"].to_numpy(dtype=float)
+
+    smoothed = sm.nonparametric.lowess(y, x, frac=frac)
+    pd.DataFrame(smoothed, columns=[f"days_end_{period}", "lowess"]).to_csv(
+        csv_path, index=False
+    )
+
+    plt.figure(figsize=(10, 5))
+    plt.scatter(x, y, s=3, color="black", alpha=0.5)
+    plt.plot(smoothed[:, 0], smoothed[:, 1], color="red", label="LOWESS")
+    plt.gca().invert_xaxis()
+    plt.title(f"{city.upper()} Citations by days to end of {period}")
+    plt.xlabel(f"Days to end of {period}")
+    plt.ylabel("Citations Issued")
+    plt.legend()
+    plt.savefig(png_path, bbox_inches="tight")
+    plt.close()
+
+
+def run_fixed_effects(data_path, out_path, n_draws=9999):
+    """
+    Save the year fixed effects estimates with wild bootstrap inference.
+
+    Parameters
+    ----------
+    data_path : str
+        The processed data file.
+    out_path : str
+        The csv file to write.
+    n_draws : int
+        The number of bootstrap draws per model. Default is 9999.
+
+    Returns
+    -------
+    None
+    """
+    from wild_bootstrap import bootstrap_table
+
+    bootstrap_table(pd.read_csv(data_path), n_draws=n_draws).to_csv(
+        out_path, index=False
+    )
+
+
+def run_pooled(data_path, out_path):
+    """
+    Save the pooled event study for every period.
+
+    Parameters
+    ----------
+    data_path : str
+        The processed data file.
+    out_path : str
+        The csv file to write.
+
+    Returns
+    -------
+    None
+    """
+    from pooled_event_study import pooled_event_study
+
+    df = pd.read_csv(data_path)
+    tables = [
+        pooled_event_study(df, period).reset_index().assign(period=period)
+        for period in PERIODS
+    ]
+    pd.concat(tables).to_csv(out_path, index=False)
+
+
+def run_count_models(data_path, out_path):
+    """
+    Save the Poisson and negative binomial estimates for every city.
+
+    Parameters
+    ----------
+    data_path : str
+        The processed data file.
+    out_path : str
+        The csv file to write.
+
+    Returns
+    -------
+    None
+    """
+    from count_models import count_model_table
+
+    df = pd.read_csv(data_path)
+    tables = [count_model_table(df, family) for family in ["poisson", "negbin"]]
+    pd.concat(tables).to_csv(out_path, index=False)
+
+
+############### Stage graph ###############
+def make_stage(name, func, inputs, outputs, **kwargs):
+    """
+    Declare one stage of the pipeline.
+
+    Parameters
+    ----------
+    name : str
+        The unique stage name.
+    func : callable
+        A module level function, so it can be sent to worker processes.
+    inputs : list
+        The files the stage reads.
+    outputs : list
+        The files the stage writes.
+    **kwargs
+        The keyword arguments passed to func.
+
+    Returns
+    -------
+    dict
+        The stage, with the source files of the modules func imports (from
+        STAGE_MODULES) under "code".
+    """
+    return {
+        "name": name,
+        "func": func,
+        "inputs": list(inputs),
+        "outputs": list(outputs),
+        "code": [
+            os.path.join(CODE_DIR, f"{module}.py")
+            for module in STAGE_MODULES.get(func.__name__, [])
+        ],
+        "kwargs": kwargs,
+    }
+
+
+def build_stages(data_path=PROCESSED_DATA, cities=None):
+    """
+    Declare every stage of the project.
+
+    The process stage only exists when source csv files are present, since
+    they are not stored in the repository. When it does, every analysis
+    stage also takes its output as an input, so it waits for the process
+    stage and reruns when the revised data changes. The step from the
+    revised data to data_path is not scripted, see check_clean_data.
+
+    Parameters
+    ----------
+    data_path : str
+        The processed data file the analysis stages read. Default is
+        PROCESSED_DATA.
+    cities : list
+        The cities to analyse. Default is None, every city in data_path.
+
+    Returns
+    -------
+    list of dict
+        The stages.
+    """
+    stages = []
+
+    source_files = sorted(glob.glob(os.path.join(SOURCE_DIR, "*.csv")))
+    if source_files:
+        stages.append(
+            make_stage(
+                "process",
+                run_process,
+                source_files,
+                [REVISED_DATA],
+                folder=SOURCE_DIR,
+                out_path=REVISED_DATA,
+            )
+        )
+
+    # inputs shared by every analysis stage
+    data_inputs = [data_path, REVISED_DATA] if source_files else [data_path]
+
+    if cities is None:
+        cities = sorted(pd.read_csv(data_path, usecols=["city"])["city"].unique())
+
+    for city in cities:
+        out_path = os.path.join(RESULTS_DIR, "missing_data", f"{city}.csv")
+        stages.append(
+            make_stage(
+                f"missing_{city}",
+                run_missing,
+                data_inputs,
+                [out_path],
+                city=city,
+                data_path=data_path,
+                out_path=out_path,
+            )
+        )
+        for period in PERIODS:
+            base = os.path.join(RESULTS_DIR, "lowess", f"{city}_end_of_{period}")
+            stages.append(
+                make_stage(
+                    f"lowess_{city}_{period}",
+                    run_lowess,
+                    data_inputs,
+                    [f"{base}.csv", f"{base}.png"],
+                    city=city,
+                    period=period,
+                    data_path=data_path,
+                    csv_path=f"{base}.csv",
+                    png_path=f"{base}.png",
+                )
+            )
+
+    for name, func in [
+        ("fixed_effects", run_fixed_effects),
+        ("pooled_event_study", run_pooled),
+        ("count_models", run_count_models),
+    ]:
+        out_path = os.path.join(RESULTS_DIR, f"{name}.csv")
+        stages.append(
+            make_stage(
+                name,
+                func,
+                data_inputs,
+                [out_path],
+                data_path=data_path,
+                out_path=out_path,
+            )
+        )
+
+    return stages
+
+
+def stage_dependencies(stages):
+    """
+    Find which stages each stage waits for.
+
+    Parameters
+    ----------
+    stages : list of dict
+        The stages.
+
+    Returns
+    -------
+    dict
+        The names of the stages writing the inputs of each stage.
+    """
+    writers = dict()
+    for stage in stages:
+        for path in stage["outputs"]:
+            if path in writers:
+                raise ValueError(f"{path} is written by two stages")
+            writers[path] = stage["name"]
+
+    return {
+        stage["name"]: {writers[path] for path in stage["inputs"] if path in writers}
+        for stage in stages
+    }
+
+
+def stage_signature(stage):
+    """
+    Hash the inputs, code and settings of a stage.
+
+    Parameters
+    ----------
+    stage : dict
+        The stage.
+
+    Returns
+    -------
+    str
+        The hex digest, which changes when any input file, the stage
+        function or an analysis module it imports changes.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(f"{stage['func'].__module__}.{stage['func'].__name__}".encode())
+    hasher.update(inspect.getsource(stage["func"]).encode())
+    hasher.update(json.dumps(stage["kwargs"], sort_keys=True, default=str).encode())
+    for path in stage["code"] + stage["inputs"]:
+        hasher.update(path.encode())
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(block)
+    return hasher.hexdigest()
+
+
+def _run_stage(stage):
+    """
+    Run one stage after making its output folders.
+
+    Parameters
+    ----------
+    stage : dict
+        The stage.
+
+    Returns
+    -------
+    str
+        The stage name.
+    """
+    for path in stage["outputs"]:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    stage["func"](**stage["kwargs"])
+    return stage["name"]
+
+
+def run_pipeline(stages, jobs=None, force=False, dry_run=False, state_file=STATE_FILE):
+    """
+    Run the stages in dependency order, in parallel, skipping fresh ones.
+
+    A stage is fresh when its outputs exist and the signature of its inputs
+    matches the one saved after its last successful run. A stage whose
+    upstream stage reruns is checked again once that stage finishes. The
+    saved signatures are always loaded and new ones are merged into them, so
+    a forced or partial run does not make the other stages look stale.
+
+    If a stage fails, no new stages are started, the stages already running
+    are allowed to finish and are recorded, and then the first error is
+    raised.
+
+    Parameters
+    ----------
+    stages : list of dict
+        The stages from build_stages.
+    jobs : int
+        The number of worker processes. Default is None, one per core.
+    force : bool
+        Whether to rerun every stage. Default is False.
+    dry_run : bool
+        Whether to only report the stages that would run. Default is False.
+    state_file : str
+        The json file holding the signatures. Default is STATE_FILE.
+
+    Returns
+    -------
+    dict
+        The status of every stage: "ran", "skipped" or "would run".
+    """
+    by_name = {stage["name"]: stage for stage in stages}
+    waiting = stage_dependencies(stages)
+
+    state = dict()
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+
+    def is_fresh(stage):
+        if force or not all(os.path.exists(path) for path in stage["outputs"]):
+            return False
+        return state.get(stage["name"]) == stage_signature(stage)
+
+    status = dict()
+    signatures = dict()
+    failures = []
+
+    if dry_run:
+        # a stage would run if it is stale or anything upstream would run
+        order = []
+        pending = {name: set(deps) for name, deps in waiting.items()}
+        while pending:
+            ready = [name for name, deps in pending.items() if not deps - set(order)]
+            if not ready:
+                raise ValueError("the stage graph has a cycle")
+            for name in sorted(ready):
+                order.append(name)
+                del pending[name]
+        for name in order:
+            upstream_runs = any(status[dep] == "would run" for dep in waiting[name])
+            stale = upstream_runs or not is_fresh(by_name[name])
+            status[name] = "would run" if stale else "skipped"
+        return status
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        running = dict()
+
+        def schedule():
+            if failures:
+                return
+            for name in sorted(waiting):
+                if name in status or name in running.values():
+                    continue
+                if any(dep not in status for dep in waiting[name]):
+                    continue
+                stage = by_name[name]
+                if is_fresh(stage):
+                    status[name] = "skipped"
+                    print(f"Skipping {name} (up to date)")
+                    continue
+                signatures[name] = stage_signature(stage)
+                print(f"Running {name}")
+                running[pool.submit(_run_stage, stage)] = name
+
+        # skipping a stage can unblock others, so schedule until nothing changes
+        while True:
+            before = len(status) + len(running)
+            schedule()
+            if len(status) + len(running) == before:
+                break
+
+        while running:
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                name = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    print(f"Failed {name}: {error!r}")
+                    failures.append(error)
+                    continue
+                status[name] = "ran"
+                state[name] = signatures[name]
+
+            while True:
+                before = len(status) + len(running)
+                schedule()
+                if len(status) + len(running) == before:
+                    break
+
+            # save after each batch so an interrupted run keeps its progress
+            os.makedirs(os.path.dirname(state_file), exist_ok=True)
+            tmp_path = f"{state_file}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(state, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, state_file)
+
+    if failures:
+        raise failures[0]
+    if len(status) != len(stages):
+        raise ValueError("the stage graph has a cycle")
+    return status
+
+
+def check_clean_data(data_path=PROCESSED_DATA):
+    """
+    Warn when the clean data is older than the revised data.
+
+    The cleaning that turns processed_data_revised.csv into
+    processed_data_clean_final.csv is done by hand, so a rebuilt revised
+    file means the analysis is still reading the old clean data.
+
+    Parameters
+    ----------
+    data_path : str
+        The processed data file the analysis stages read. Default is
+        PROCESSED_DATA.
+
+    Returns
+    -------
+    bool
+        True if the clean data is at least as new as the revised data.
+    """
+    if not os.path.exists(REVISED_DATA) or not os.path.exists(data_path):
+        return True
+    if os.path.getmtime(data_path) >= os.path.getmtime(REVISED_DATA):
+        return True
+    print(
+        f"Warning: {os.path.relpath(data_path, ROOT)} is older than "
+        f"{os.path.relpath(REVISED_DATA, ROOT)}, update the clean data before "
+        "trusting the analysis outputs"
+    )
+    return False
+
+
+def main():
+    """
+    Run the pipeline from the command line.
+
+    Returns
+    -------
+    None
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=None, help="worker processes")
+    parser.add_argument("--force", action="store_true", help="rerun every stage")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only list the stages that would run"
+    )
+    parser.add_argument("--only", nargs="+", help="stage names or prefixes to run")
+    parser.add_argument("--data", default=PROCESSED_DATA, help="processed data file")
+    args = parser.parse_args()
+
+    stages = build_stages(data_path=os.path.abspath(args.data))
+    if args.only:
+        stages = [
+            stage
+            for stage in stages
+            if any(stage["name"].startswith(prefix) for prefix in args.only)
+        ]
+
+    check_clean_data(os.path.abspath(args.data))
+    status = run_pipeline(stages, args.jobs, args.force, args.dry_run)
+    if args.dry_run:
+        for name, label in status.items():
+            if label == "would run":
+                print(f"Would run {name}")
+    counts = pd.Series(status).value_counts()
+    print(", ".join(f"{count} {label}" for label, count in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""File for the pooled multi-city event study with absorbed fixed effects."""
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+
+############### Settings ###############
+
+# number of days before each deadline that get their own coefficient, these
+# match the end_of_* flags made in data_preprocess.py
+PERIOD_WINDOWS = {"month": 5, "quarter": 10, "year": 15}
+
+
+############### Functions ###############
+def demean(values, groups, tol=1e-10, max_iter=1000):
+    """
+    Remove several sets of fixed effects by alternating projections.
+
+    Each pass subtracts the group means of one fixed effect at a time until
+    the columns stop changing, which gives the same residuals as regressing
+    on every dummy without ever building the dummy matrix.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        The (n,) or (n, k) array to demean.
+    groups : list of numpy.ndarray
+        One integer code array of length n per fixed effect.
+    tol : float
+        The largest change allowed in a pass before stopping. Default is 1e-10.
+    max_iter : int
+        The maximum number of passes. Default is 1000.
+
+    Returns
+    -------
+    numpy.ndarray
+        The demeaned array, with the same shape as values.
+    """
+    out = np.array(values, dtype=float, copy=True)
+    flat = out.ndim == 1
+    if flat:
+        out = out[:, None]
+
+    counts = [np.bincount(codes) for codes in groups]
+    scale = max(np.abs(out).max(), 1.0) if out.size else 1.0
+
+    for _ in range(max_iter):
+        change = 0.0
+        for codes, count in zip(groups, counts):
+            # group means for every column at once
+            sums = np.zeros((len(count), out.shape[1]))
+            np.add.at(sums, codes, out)
+            means = sums / count[:, None]
+            out -= means[codes]
+            change = max(change, np.abs(means).max())
+        # a single fixed effect is removed exactly in one pass
+        if change <= tol * scale or len(groups) == 1:
+            break
+
+    return out[:, 0] if flat else out
+
+
+def event_design(df, period, window=None):
+    """
+    Build the day-to-deadline dummies for the event study.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The processed data. Must have a days_end_<period> column.
+    period : str
+        The reporting period. Can be one of month, quarter, or year.
+    window : int
+        The number of days before the deadline to estimate. Days further
+        out are the reference group. Default is PERIOD_WINDOWS[period].
+
+    Returns
+    -------
+    design : numpy.ndarray
+        The (n, window + 1) dummy matrix.
+    names : list
+        The column names, days_to_end_0 to days_to_end_<window>.
+    """
+    if period not in PERIOD_WINDOWS:
+        raise ValueError(f"period must be one of {list(PERIOD_WINDOWS)}")
+    if window is None:
+        window = PERIOD_WINDOWS[period]
+
+    days = df[f"days_end_{period}"].to_numpy().astype(int)
+    design = (days[:, None] == np.arange(window + 1)[None, :]).astype(float)
+    names = [f"days_to_end_{day}" for day in range(window + 1)]
+    return design, names
+
+
+def fit_absorbed(y, X, groups, clusters=None, cov_type="clustered"):
+    """
+    Fit OLS after absorbing fixed effects and compute the covariance.
+
+    Parameters
+    ----------
+    y : numpy.ndarray
+        The (n,) outcome.
+    X : numpy.ndarray
+        The (n, k) regressors of interest.
+    groups : list of numpy.ndarray
+        One integer code array per fixed effect to absorb.
+    clusters : numpy.ndarray
+        Integer cluster codes. Required when cov_type is "clustered".
+    cov_type : str
+        One of "clustered", "robust" or "unadjusted". Default is "clustered".
+
+    Returns
+    -------
+    dict
+        The coefficients (params), covariance (cov), residuals (resid),
+        degrees of freedom for inference (df_resid) and the demeaned
+        regressors (X_tilde).
+    """
+    n, k = X.shape
+
+    # absorb the fixed effects from the outcome and regressors together
+    both = demean(np.column_stack([y, X]), groups)
+    y_tilde, X_tilde = both[:, 0], both[:, 1:]
+
+    bread = np.linalg.pinv(X_tilde.T @ X_tilde)
+    params = bread @ X_tilde.T @ y_tilde
+    resid = y_tilde - X_tilde @ params
+
+    # absorbed levels less one per extra fixed effect for the shared constant
+    n_absorbed = sum(len(np.unique(codes)) for codes in groups) - (len(groups) - 1)
+
+    if cov_type == "clustered":
+        if clusters is None:
+            raise ValueError("clusters are required for clustered errors")
+        n_clusters = len(np.unique(clusters))
+        scores = np.zeros((clusters.max() + 1, k))
+        np.add.at(scores, clusters, X_tilde * resid[:, None])
+        meat = scores.T @ scores
+        # Stata style small sample correction
+        correction = n_clusters / (n_clusters - 1) * (n - 1) / (n - k)
+        cov = correction * bread @ meat @ bread
+        df_resid = n_clusters - 1
+    elif cov_type == "robust":
+        meat = (X_tilde * resid[:, None] ** 2).T @ X_tilde
+        df_resid = n - k - n_absorbed
+        cov = n / df_resid * bread @ meat @ bread
+    elif cov_type == "unadjusted":
+        df_resid = n - k - n_absorbed
+        cov = resid @ resid / df_resid * bread
+    else:
+        raise ValueError("cov_type must be clustered, robust or unadjusted")
+
+    return {
+        "params": params,
+        "cov": cov,
+        "resid": resid,
+        "df_resid": df_resid,
+        "X_tilde": X_tilde,
+    }
+
+
+def coef_table(names, params, cov, df_resid, conf_interval=0.95):
+    """
+    Make a tidy table of coefficients and their inference.
+
+    Parameters
+    ----------
+    names : list
+        The coefficient names.
+    params : numpy.ndarray
+        The coefficients.
+    cov : numpy.ndarray
+        The covariance of the coefficients.
+    df_resid : int
+        The degrees of freedom of the t distribution.
+    conf_interval : float
+        The confidence level. Default is 0.95.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per coefficient with coef, std_err, t_stat, p_value,
+        ci_lower and ci_upper.
+    """
+    std_err = np.sqrt(np.diag(cov))
+    t_stat = params / std_err
+    p_value = 2 * stats.t.sf(np.abs(t_stat), df_resid)
+    crit = stats.t.ppf(1 - (1 - conf_interval) / 2, df_resid)
+    return pd.DataFrame(
+        {
+            "coef": params,
+            "std_err": std_err,
+            "t_stat": t_stat,
+            "p_value": p_value,
+            "ci_lower": params - crit * std_err,
+            "ci_upper": params + crit * std_err,
+        },
+        index=pd.Index(names, name="term"),
+    )
+
+
+def pooled_event_study(
+    df,
+    period="month",
+    metric="citation_issued",
+    window=None,
+    cluster="city",
+    cov_type="clustered",
+):
+    """
+    Estimate one day-to-deadline profile pooled across every city.
+
+    The model has a coefficient for each of the last window + 1 days before
+    the deadline, with city x year and day-of-week fixed effects absorbed
+    by demeaning instead of dummies.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The processed data.
+    period : str
+        The reporting period. Can be one of month, quarter, or year.
+    metric : str
+        The outcome column. Default is "citation_issued." Can be set to
+        "citation_rate."
+    window : int
+        The number of days before the deadline to estimate. Default is
+        PERIOD_WINDOWS[period].
+    cluster : str
+        The column to cluster on. Can be "city" or "city_year". Default is
+        "city".
+    cov_type : str
+        One of "clustered", "robust" or "unadjusted". Default is "clustered".
+
+    Returns
+    -------
+    pandas.DataFrame
+        The coefficient table from coef_table, with the number of
+        observations stored in attrs["nobs"].
+    """
+    df = df.dropna(subset=[metric, f"days_end_{period}"])
+
+    X, names = event_design(df, period, window)
+    y = df[metric].to_numpy(dtype=float)
+
+    # integer codes for each fixed effect
+    city_year = pd.factorize(df["city"].astype(str) + "_" + df["year"].astype(str))[0]
+    day_of_week = pd.factorize(df["day_of_week"])[0]
+
+    if cluster == "city":
+        clusters = pd.factorize(df["city"])[0]
+    elif cluster == "city_year":
+        clusters = city_year
+    else:
+        raise ValueError("cluster must be city or city_year")
+
+    fit = fit_absorbed(y, X, [city_year, day_of_week], clusters, cov_type)
+
+    table = coef_table(names, fit["params"], fit["cov"], fit["df_resid"])
+    table.attrs["nobs"] = len(y)
+    return table
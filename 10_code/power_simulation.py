@@ -0,0 +1,414 @@
+"""File for simulating the power to detect end of period uplifts in each city."""
+
+import concurrent.futures
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+
+############### Settings ###############
+
+PERIODS = ["month", "quarter", "year"]
+
+# relative uplifts on end of period days, 0 gives the false positive rate
+UPLIFTS = [0.0, 0.05, 0.1, 0.2, 0.3, 0.5]
+
+# replicates held in memory at once for each (city, period)
+CHUNK_SIZE = 500
+
+# days in each resampled block, whole weeks so the day of week is kept
+BLOCK_DAYS = 28
+
+
+############### Functions ###############
+def _city_arrays(city_df, period, metric, block_days=BLOCK_DAYS):
+    """
+    Prepare the arrays one city needs, sorted by (year, day of week) cell.
+
+    Every year is laid out as a grid of calendar days from its first date and
+    cut into blocks of block_days. A block can be redrawn from any stretch of
+    the same year that starts a whole number of weeks away, which the block
+    arrays describe.
+
+    Parameters
+    ----------
+    city_df : pandas.DataFrame
+        The processed data of one city.
+    period : str
+        The reporting period. Can be one of month, quarter, or year.
+    metric : str
+        The outcome column.
+    block_days : int
+        The days in a block. Must be a multiple of 7. Default is BLOCK_DAYS.
+
+    Returns
+    -------
+    dict
+        The outcome (y), flag (x), year codes (years), cell codes (cells),
+        cell starts (starts) and cell sizes (sizes). For the blocks, the
+        block of each row (block), its day within the block (offset), the
+        grid position each block's year starts at (block_base), the number
+        of weekly starts each block can be drawn from (block_starts) and the
+        row of every grid day, -1 where the day is missing (grid).
+    """
+    if block_days % 7 != 0:
+        raise ValueError("block_days must be a multiple of 7")
+
+    cells = pd.factorize(
+        city_df["year"].astype(str) + "_" + city_df["day_of_week"].astype(str)
+    )[0]
+    order = np.argsort(cells, kind="stable")
+    cells = cells[order]
+    sizes = np.bincount(cells)
+    years = pd.factorize(city_df["year"])[0][order]
+
+    # position of every day in the calendar grid of its year
+    dates = pd.to_datetime(city_df["date"]).to_numpy()[order]
+    first = pd.Series(dates).groupby(years).transform("min").to_numpy()
+    day = ((dates - first) // np.timedelta64(1, "D")).astype(int)
+    span = pd.Series(day + 1).groupby(years).max().to_numpy()
+    if span.min() < block_days:
+        raise ValueError("every year must span at least block_days days")
+    year_base = np.concatenate([[0], np.cumsum(span)[:-1]])
+
+    grid = np.full(span.sum(), -1)
+    grid[year_base[years] + day] = np.arange(len(day))
+
+    # blocks are numbered across years, each year starting a new block
+    n_blocks = -(-span // block_days)
+    block_first = np.concatenate([[0], np.cumsum(n_blocks)[:-1]])
+    block_year = np.repeat(np.arange(len(span)), n_blocks)
+
+    return {
+        "y": city_df[metric].to_numpy(dtype=float)[order],
+        "x": city_df[f"end_of_{period}"].to_numpy(dtype=float)[order],
+        "years": years,
+        "cells": cells,
+        "starts": np.concatenate([[0], np.cumsum(sizes)[:-1]]),
+        "sizes": sizes,
+        "block": block_first[years] + day // block_days,
+        "offset": day % block_days,
+        "block_base": year_base[block_year],
+        "block_starts": (span[block_year] - block_days) // 7 + 1,
+        "grid": grid,
+    }
+
+
+def _resample(arrays, reps, rng):
+    """
+    Draw the row of every day in a chunk of replicates by block resampling.
+
+    Each block of a year is replaced by a stretch of the same length from
+    the same year, starting a whole number of weeks from the start of the
+    year so every day keeps its day of week. Days inside a block keep their
+    real neighbours, so serial correlation and the seasonality within a
+    block carry over to the flagged days. A day whose source day is missing
+    from the data is drawn from its (year, day of week) cell instead.
+
+    Parameters
+    ----------
+    arrays : dict
+        The output of _city_arrays.
+    reps : int
+        The number of replicates.
+    rng : numpy.random.Generator
+        The random generator.
+
+    Returns
+    -------
+    numpy.ndarray
+        The (reps, n) rows of y to use in each replicate.
+    """
+    block_starts = arrays["block_starts"]
+    weeks = (rng.random((reps, len(block_starts))) * block_starts).astype(int)
+    source = arrays["block_base"] + 7 * weeks
+    index = arrays["grid"][source[:, arrays["block"]] + arrays["offset"]]
+
+    missing = index < 0
+    if missing.any():
+        cells = np.broadcast_to(arrays["cells"], index.shape)[missing]
+        draws = rng.random(missing.sum())
+        index[missing] = arrays["starts"][cells] + (
+            draws * arrays["sizes"][cells]
+        ).astype(int)
+    return index
+
+
+def simulate_power(
+    arrays,
+    uplifts=UPLIFTS,
+    n_reps=2000,
+    alpha=0.05,
+    cov_type="clustered",
+    seed=None,
+    chunk_size=CHUNK_SIZE,
+):
+    """
+    Estimate the detection power of one city and period.
+
+    Each replicate rebuilds every year from contiguous blocks of its own
+    days shifted by whole weeks (see _resample), which keeps the level,
+    weekly pattern and serial dependence of the data but moves the end of
+    period days to random points of the year, removing any real effect.
+    The uplift is then added to the flagged days as a share of their value,
+    and the effect is re-estimated with (year, day of week) fixed effects so
+    the weekday makeup of the flagged days cannot leak into the estimate. A
+    replicate detects the uplift when the two-sided test rejects at alpha
+    with a positive estimate, so with no uplift about alpha / 2 of the
+    replicates should detect one (see size_check).
+
+    The curves describe this (year, day of week) fixed effects estimator,
+    not the year fixed effects PanelOLS models of the notebooks. Standard
+    errors are clustered by year by default, as days within a year are
+    correlated and unadjusted errors overstate the power.
+
+    The demeaned flag is the same in every replicate, so the estimates of
+    a whole chunk are one matrix product and the per cell and per year sums
+    needed for the standard errors are two more.
+
+    Parameters
+    ----------
+    arrays : dict
+        The output of _city_arrays.
+    uplifts : list
+        The relative uplifts to inject. Default is UPLIFTS.
+    n_reps : int
+        The number of replicates per uplift. Default is 2000.
+    alpha : float
+        The significance level. Default is 0.05.
+    cov_type : str
+        Can be "clustered" by year or "unadjusted". Default is
+        "clustered".
+    seed : int or numpy.random.SeedSequence
+        The seed for the random generator. Default is None.
+    chunk_size : int
+        The replicates simulated at once. Default is CHUNK_SIZE.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per uplift with the power and the mean estimate relative to
+        the mean of the redrawn flagged days before the uplift
+        (mean_relative_estimate).
+    """
+    if cov_type not in ["unadjusted", "clustered"]:
+        raise ValueError("cov_type must be unadjusted or clustered")
+
+    rng = np.random.default_rng(seed)
+    y, x, years, cells = arrays["y"], arrays["x"], arrays["years"], arrays["cells"]
+    n, n_years, n_cells = len(y), years.max() + 1, cells.max() + 1
+
+    year_onehot = np.zeros((n, n_years))
+    year_onehot[np.arange(n), years] = 1.0
+    cell_onehot = np.zeros((n, n_cells))
+    cell_onehot[np.arange(n), cells] = 1.0
+    counts = arrays["sizes"]
+
+    # the flag demeaned by (year, day of week) cell, shared by every replicate
+    x_tilde = x - (x @ cell_onehot / counts)[cells]
+    xx = x_tilde @ x_tilde
+    w = (x_tilde**2) @ year_onehot
+
+    if cov_type == "unadjusted":
+        crit = stats.t.ppf(1 - alpha / 2, n - n_cells - 1)
+    else:
+        crit = stats.t.ppf(1 - alpha / 2, n_years - 1)
+
+    flagged = x == 1
+    baseline = 0.0
+    detected = np.zeros(len(uplifts))
+    estimates = np.zeros(len(uplifts))
+
+    for start in range(0, n_reps, chunk_size):
+        reps = min(chunk_size, n_reps - start)
+
+        Y0 = y[_resample(arrays, reps, rng)]
+        baseline += Y0[:, flagged].mean(axis=1).sum()
+
+        for i, uplift in enumerate(uplifts):
+            Y = Y0 * (1 + uplift * x)
+            coef = Y @ x_tilde / xx
+
+            if cov_type == "unadjusted":
+                cell_sums = Y @ cell_onehot
+                ss = (Y**2).sum(axis=1) - ((cell_sums**2) / counts).sum(axis=1)
+                rss = ss - coef**2 * xx
+                std_err = np.sqrt(rss / (n - n_cells - 1) / xx)
+            else:
+                # cells nest in years, so x_tilde sums to zero within a year
+                scores = (Y * x_tilde) @ year_onehot - coef[:, None] * w
+                std_err = (
+                    np.sqrt(n_years / (n_years - 1) * (scores**2).sum(axis=1)) / xx
+                )
+
+            detected[i] += np.sum(coef / std_err > crit)
+            estimates[i] += coef.sum()
+
+    return pd.DataFrame(
+        {
+            "uplift": uplifts,
+            "power": detected / n_reps,
+            "mean_relative_estimate": estimates / baseline,
+            "n_reps": n_reps,
+        }
+    )
+
+
+def _power_task(args):
+    """
+    Run simulate_power for one (city, period) in a worker process.
+
+    Parameters
+    ----------
+    args : tuple
+        The city, period, arrays and keyword arguments of simulate_power.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The power table with city and period columns.
+    """
+    city, period, arrays, kwargs = args
+    table = simulate_power(arrays, **kwargs)
+    table.insert(0, "period", period)
+    table.insert(0, "city", city)
+    return table
+
+
+def power_curves(
+    df,
+    cities=None,
+    periods=PERIODS,
+    uplifts=UPLIFTS,
+    metric="citation_issued",
+    n_reps=2000,
+    alpha=0.05,
+    cov_type="clustered",
+    seed=0,
+    block_days=BLOCK_DAYS,
+    jobs=None,
+):
+    """
+    Simulate detection power curves for every city and period.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The processed data.
+    cities : list
+        The cities to simulate. Default is None, every city in df.
+    periods : list
+        The reporting periods. Default is PERIODS.
+    uplifts : list
+        The relative uplifts to inject. Default is UPLIFTS.
+    metric : str
+        The outcome. Default is "citation_issued."
+    n_reps : int
+        The number of replicates per uplift. Default is 2000.
+    alpha : float
+        The significance level. Default is 0.05.
+    cov_type : str
+        Can be "clustered" or "unadjusted". Default is "clustered".
+    seed : int
+        The seed, split into one independent stream per task. Default is 0.
+    block_days : int
+        The days in each resampled block. Default is BLOCK_DAYS.
+    jobs : int
+        The number of worker processes. Default is None, one per core. Use
+        1 to run in the current process.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per (city, period, uplift) with the power.
+    """
+    if cities is None:
+        cities = sorted(df["city"].unique())
+
+    tasks = [(city, period) for city in cities for period in periods]
+    seeds = np.random.SeedSequence(seed).spawn(len(tasks))
+    args = [
+        (
+            city,
+            period,
+            _city_arrays(df[df["city"] == city], period, metric, block_days),
+            {
+                "uplifts": uplifts,
+                "n_reps": n_reps,
+                "alpha": alpha,
+                "cov_type": cov_type,
+                "seed": task_seed,
+            },
+        )
+        for (city, period), task_seed in zip(tasks, seeds)
+    ]
+
+    if jobs == 1:
+        tables = [_power_task(arg) for arg in args]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            tables = list(pool.map(_power_task, args))
+
+    return pd.concat(tables, ignore_index=True)
+
+
+def size_check(power, alpha=0.05, n_se=3):
+    """
+    Check that the false positive rate with no uplift is about alpha / 2.
+
+    Parameters
+    ----------
+    power : pandas.DataFrame
+        The output of power_curves. Must include uplift 0.
+    alpha : float
+        The significance level used in power_curves. Default is 0.05.
+    n_se : float
+        The number of Monte Carlo standard errors allowed. Default is 3.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The uplift 0 rows with the expected rate (expected), the Monte
+        Carlo standard error (mc_se) and whether the rate is within n_se of
+        the expected rate (ok).
+    """
+    null = power[power["uplift"] == 0].copy()
+    if null.empty:
+        raise ValueError("power has no rows with uplift 0")
+
+    null["expected"] = alpha / 2
+    null["mc_se"] = np.sqrt(alpha / 2 * (1 - alpha / 2) / null["n_reps"])
+    null["ok"] = (null["power"] - null["expected"]).abs() <= n_se * null["mc_se"]
+    return null
+
+
+def plot_power_curves(power, period):
+    """
+    Plot the power curve of every city for one period.
+
+    Parameters
+    ----------
+    power : pandas.DataFrame
+        The output of power_curves.
+    period : str
+        The reporting period to plot.
+
+    Returns
+    -------
+    None
+    """
+    period_data = power[power["period"] == period]
+
+    plt.figure(figsize=(10, 6))
+    for city, city_data in period_data.groupby("city"):
+        plt.plot(city_data["uplift"] * 100, city_data["power"], marker="o", label=city)
+
+    plt.axhline(0.8, color="grey", linestyle="--", linewidth=1)
+    plt.title(f"Power to detect an end of {period} uplift", fontsize=16)
+    plt.xlabel("Uplift on end of period days (%)", fontsize=14)
+    plt.ylabel("Power", fontsize=14)
+    plt.ylim(0, 1)
+    plt.legend(fontsize=8, ncol=3)
+    plt.show()
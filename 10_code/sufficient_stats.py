@@ -0,0 +1,320 @@
+"""File for updating the end of period effects as new days of data arrive."""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+
+############### Settings ###############
+
+PERIODS = ["month", "quarter", "year"]
+
+METRICS = ["citation_issued", "citation_rate"]
+
+# statistics kept for every (city, year) cell, 0 is outside and 1 inside the
+# end of period window: day counts, sums and sums of squares of the metric
+CELL_STATS = ["n0", "n1", "s0", "s1", "q0", "q1"]
+
+# running totals over the years of a city that every estimate is read from
+TOTAL_STATS = ["nobs", "n_years", "a", "w", "ss", "aa", "aw", "ww"]
+
+
+############### Functions ###############
+def _year_terms(cell):
+    """
+    Get the within-year pieces of the effect from one cell.
+
+    With a 0/1 flag x and year fixed effects, year t adds
+    a = sum(x~ y~) = n1 n0 / n (mean1 - mean0), w = sum(x~^2) = n1 n0 / n and
+    ss = sum(y~^2) to the normal equations.
+
+    Parameters
+    ----------
+    cell : numpy.ndarray
+        The CELL_STATS of one (city, year).
+
+    Returns
+    -------
+    numpy.ndarray
+        The contribution to TOTAL_STATS.
+    """
+    n0, n1, s0, s1, q0, q1 = cell
+    n = n0 + n1
+    if n == 0:
+        return np.zeros(len(TOTAL_STATS))
+
+    w = n1 * n0 / n
+    a = s1 - n1 * (s0 + s1) / n
+    ss = q0 + q1 - (s0 + s1) ** 2 / n
+    return np.array([n, 1.0, a, w, ss, a * a, a * w, w * w])
+
+
+def _dates_path(path):
+    """
+    Get the path of the stored days that goes with a saved store.
+
+    Parameters
+    ----------
+    path : str
+        The csv file of the cell statistics.
+
+    Returns
+    -------
+    str
+        The csv file of the stored days.
+    """
+    stem, ext = os.path.splitext(path)
+    return f"{stem}_dates{ext or '.csv'}"
+
+
+class SufficientStatsStore:
+    """
+    Per (city, year, end of period flag) sufficient statistics.
+
+    Each update adds the new days to their (city, year) cells and swaps the
+    old contribution of those years for the new one in the city totals, so
+    reading an effect never rescans history. The effect is the one from the
+    fixed effects notebooks, metric on the end of period flag with year
+    effects, and matches a PanelOLS fit with TimeEffects.
+
+    The store keeps the dates it holds for each city, so rows for days it
+    already has are skipped rather than counted twice.
+    """
+
+    def __init__(self):
+        self.cells = dict()
+        self.totals = dict()
+        self.dates = dict()
+
+    def update(self, df):
+        """
+        Add new daily rows from data_process.
+
+        Rows for (city, date) pairs already in the store, or repeated within
+        df, are skipped, so passing the whole re-exported panel only adds the
+        new days.
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            Rows of the processed data, with the date as a column or index.
+
+        Returns
+        -------
+        int
+            The number of rows skipped because their day was already stored.
+        """
+        if "date" in df.columns:
+            dates = df["date"]
+        else:
+            dates = pd.Series(df.index, index=df.index)
+        dates = pd.to_datetime(dates).dt.strftime("%Y-%m-%d")
+
+        # keep only the first row of every (city, date) not yet stored
+        keys = list(zip(df["city"], dates))
+        new = ~pd.Series(keys, index=df.index).duplicated().to_numpy()
+        for i, (city, date) in enumerate(keys):
+            if new[i] and date in self.dates.get(city, ()):
+                new[i] = False
+        skipped = int((~new).sum())
+        df = df[new]
+        for city, date in zip(df["city"], dates[new]):
+            self.dates.setdefault(city, set()).add(date)
+
+        for period in PERIODS:
+            flag = df[f"end_of_{period}"].astype(bool)
+            for metric in METRICS:
+                y = df[metric].astype(float)
+                grouped = (
+                    pd.DataFrame(
+                        {
+                            "city": df["city"],
+                            "year": df["year"],
+                            "flag": flag,
+                            "n": 1.0,
+                            "s": y,
+                            "q": y**2,
+                        }
+                    )
+                    .groupby(["city", "year", "flag"])[["n", "s", "q"]]
+                    .sum()
+                )
+
+                for (city, year, inside), (n, s, q) in grouped.iterrows():
+                    key = (city, period, metric)
+                    cells = self.cells.setdefault(key, dict())
+                    totals = self.totals.setdefault(key, np.zeros(len(TOTAL_STATS)))
+                    cell = cells.setdefault(int(year), np.zeros(len(CELL_STATS)))
+
+                    # swap this year's old contribution for the new one
+                    totals -= _year_terms(cell)
+                    cell[[int(inside), 2 + int(inside), 4 + int(inside)]] += [n, s, q]
+                    totals += _year_terms(cell)
+
+        return skipped
+
+    def effect(self, city, period, metric="citation_issued"):
+        """
+        Read the year-demeaned end of period effect of a city.
+
+        Parameters
+        ----------
+        city : str
+            The city name.
+        period : str
+            The reporting period. Can be one of month, quarter, or year.
+        metric : str
+            The outcome. Default is "citation_issued." Can be set to
+            "citation_rate."
+
+        Returns
+        -------
+        dict
+            The coefficient (coef), its unadjusted (std_err) and year
+            clustered (std_err_clustered) standard errors, the number of
+            observations (nobs) and years (n_years).
+        """
+        key = (city, period, metric)
+        if key not in self.totals:
+            raise KeyError(f"no data for {city} {period} {metric}")
+        nobs, n_years, a, w, ss, aa, aw, ww = self.totals[key]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            coef = a / w
+            rss = ss - a * a / w
+            std_err = np.sqrt(rss / (nobs - n_years - 1) / w)
+            # CR1 by year, from sum over years of (a_t - coef w_t)^2
+            scores = aa - 2 * coef * aw + coef**2 * ww
+            std_err_clustered = np.sqrt(n_years / (n_years - 1) * scores) / w
+
+        return {
+            "coef": float(coef),
+            "std_err": float(std_err),
+            "std_err_clustered": float(std_err_clustered),
+            "nobs": int(nobs),
+            "n_years": int(n_years),
+        }
+
+    def effects(self, metric="citation_issued"):
+        """
+        Read the effect of every city and period.
+
+        Parameters
+        ----------
+        metric : str
+            The outcome. Default is "citation_issued."
+
+        Returns
+        -------
+        pandas.DataFrame
+            One row per (city, period) with the fields of effect.
+        """
+        rows = [
+            {"city": city, "period": period, **self.effect(city, period, metric)}
+            for city, period, key_metric in sorted(self.totals)
+            if key_metric == metric
+        ]
+        return pd.DataFrame(rows)
+
+    def to_frame(self):
+        """
+        Get the cell statistics as a dataframe.
+
+        Returns
+        -------
+        pandas.DataFrame
+            One row per (city, period, metric, year) with the CELL_STATS.
+        """
+        rows = [
+            [city, period, metric, year, *cell]
+            for (city, period, metric), cells in self.cells.items()
+            for year, cell in cells.items()
+        ]
+        return pd.DataFrame(
+            rows, columns=["city", "period", "metric", "year"] + CELL_STATS
+        )
+
+    def dates_frame(self):
+        """
+        Get the stored (city, date) pairs as a dataframe.
+
+        Returns
+        -------
+        pandas.DataFrame
+            One row per stored day with city and date.
+        """
+        rows = [
+            [city, date]
+            for city, dates in sorted(self.dates.items())
+            for date in sorted(dates)
+        ]
+        return pd.DataFrame(rows, columns=["city", "date"])
+
+    @classmethod
+    def from_frame(cls, frame, dates=None):
+        """
+        Rebuild a store from the output of to_frame and dates_frame.
+
+        Parameters
+        ----------
+        frame : pandas.DataFrame
+            The cell statistics.
+        dates : pandas.DataFrame
+            The stored days. Default is None, no days are known, so later
+            updates cannot detect overlaps.
+
+        Returns
+        -------
+        SufficientStatsStore
+            The store.
+        """
+        store = cls()
+        if dates is not None:
+            for city, date in zip(dates["city"], dates["date"].astype(str)):
+                store.dates.setdefault(city, set()).add(date)
+        for row in frame.itertuples(index=False):
+            key = (row.city, row.period, row.metric)
+            cell = np.array([getattr(row, stat) for stat in CELL_STATS], dtype=float)
+            store.cells.setdefault(key, dict())[int(row.year)] = cell
+            totals = store.totals.setdefault(key, np.zeros(len(TOTAL_STATS)))
+            totals += _year_terms(cell)
+        return store
+
+    def save(self, path):
+        """
+        Save the store to a csv file, with the stored days next to it.
+
+        Parameters
+        ----------
+        path : str
+            The csv file to write. The days go to the same name with a
+            _dates suffix.
+
+        Returns
+        -------
+        None
+        """
+        self.to_frame().to_csv(path, index=False)
+        self.dates_frame().to_csv(_dates_path(path), index=False)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a store saved with save, or an empty store if there is no file.
+
+        Parameters
+        ----------
+        path : str
+            The csv file to read.
+
+        Returns
+        -------
+        SufficientStatsStore
+            The store.
+        """
+        if not os.path.exists(path):
+            return cls()
+        dates_path = _dates_path(path)
+        dates = pd.read_csv(dates_path) if os.path.exists(dates_path) else None
+        return cls.from_frame(pd.read_csv(path), dates)